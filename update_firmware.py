@@ -24,7 +24,55 @@ import can
 import time
 import struct
 import sys
-from typing import Optional
+import os
+import re
+import socket
+import select
+import signal
+import argparse
+import binascii
+import subprocess
+import zlib
+from typing import Callable, List, Optional, Tuple, Union
+from can.typechecking import CanFilter
+
+try:
+    from pyroute2 import IPRoute
+    from pyroute2.netlink.exceptions import NetlinkError
+except ImportError:  # Optional: fall back to the ip(8) command
+    IPRoute = None  # type: ignore
+
+_IFF_UP = 0x1
+
+class _CobIdReader(can.BufferedReader):
+    """
+    BufferedReader that only queues frames with one COB-ID.
+    
+    Unlike the base class, stop() also wakes a get_message() that is
+    already blocked, and frames arriving afterwards are dropped silently.
+    """
+    
+    def __init__(self, cob_id: int):
+        super().__init__()
+        self.cob_id = cob_id
+    
+    def on_message_received(self, msg: can.Message) -> None:
+        if msg.arbitration_id == self.cob_id and not self.is_stopped:
+            super().on_message_received(msg)
+    
+    def stop(self) -> None:
+        super().stop()
+        # Wakes a get_message() blocked on the empty queue
+        self.buffer.put(None)  # type: ignore[arg-type]
+
+
+def node_filters(node_id: int) -> List[CanFilter]:
+    """python-can filters for a node's SDO responses and heartbeats."""
+    return [
+        {"can_id": 0x580 + node_id, "can_mask": 0x7FF, "extended": False},
+        {"can_id": 0x700 + node_id, "can_mask": 0x7FF, "extended": False},
+    ]
+
 
 class FirmwareUpdater:
     """
@@ -33,12 +81,141 @@ class FirmwareUpdater:
     Uses CANopen SDO protocol for bootloader communication and firmware upload.
     """
     
-    def __init__(self, bus: can.Bus, node_id: int):
+    # Segment ACK wait: doubled on every retransmit of the same segment.
+    # The first wait must outlast bootloader stalls such as a sector erase:
+    # resending a segment the server already has makes a strict server
+    # abort on the repeated toggle bit.
+    SEGMENT_TIMEOUT = 2.0
+    SEGMENT_TIMEOUT_MAX = 5.0
+    SEGMENT_ATTEMPTS = 4
+    
+    # Program Control retransmit: grows 1.5x per unanswered write
+    PROGRAM_RETRY = 0.05
+    PROGRAM_RETRY_MAX = 1.0
+    # Devices that send no heartbeats get this long to restart before
+    # Program Control is read back instead of waiting for a bootup
+    BOOTUP_FALLBACK = 2.0
+    
+    # Progress lines (and callbacks) are at least this far apart, so small
+    # images do not print every 10% step within a few milliseconds
+    PROGRESS_INTERVAL = 0.25
+    
+    def __init__(self, bus: can.BusABC, node_id: int,
+                 progress_callback: Optional[Callable[[int, int], None]] = None,
+                 tx_batch: int = 4, tx_batch_delay: float = 0.0,
+                 segment_timeout: float = SEGMENT_TIMEOUT,
+                 segment_attempts: int = SEGMENT_ATTEMPTS):
+        """
+        Args:
+            bus: Open CAN bus
+            node_id: CANopen node ID of the device (1-127)
+            progress_callback: Called as (bytes_sent, total_bytes) at every
+                progress step of an upload
+            tx_batch: Block download segments sent back-to-back before pausing
+            tx_batch_delay: Pause between batches in seconds (0, the default,
+                disables pacing)
+            segment_timeout: First wait for a segment ACK in seconds; doubled
+                on every retransmit up to SEGMENT_TIMEOUT_MAX (or up to
+                segment_timeout itself if that is longer)
+            segment_attempts: Transmissions of a segment before giving up;
+                also the number of block download sub-blocks in a row the
+                server may acknowledge without progress
+        """
         self.bus = bus
         self.node_id = node_id
+        self.tx_batch = max(1, tx_batch)
+        self.tx_batch_delay = tx_batch_delay
+        self.segment_timeout = segment_timeout
+        self.segment_attempts = max(1, segment_attempts)
+        # Resolved once here so reporting progress never has to test for a
+        # missing callback; exceptions from the callback abort the upload
+        self._notify = progress_callback if progress_callback is not None else self._noop
         self.sdo_tx = 0x600 + node_id
         self.sdo_rx = 0x580 + node_id
+        self.heartbeat_id = 0x700 + node_id
         
+        # Let the kernel drop everything except our SDO responses and
+        # heartbeats (other nodes, PDOs) and collect them on the notifier thread
+        self._sdo_filter, self._heartbeat_filter = node_filters(node_id)
+        self.bus.set_filters([self._sdo_filter, self._heartbeat_filter])
+        self._reader = _CobIdReader(self.sdo_rx)
+        self._heartbeats = _CobIdReader(self.heartbeat_id)
+        self._notifier = can.Notifier(self.bus, [self._reader, self._heartbeats], timeout=0.1)
+        
+        # Requests sent repeatedly (mode switches and status polls)
+        # are built once; only the program byte is patched before sending
+        self._program_request = can.Message(
+            arbitration_id=self.sdo_tx,
+            data=bytearray(struct.pack('<BHBB3x', 0x2F, 0x1F51, 0x01, 0)),
+            is_extended_id=False
+        )
+        self._program_read_request = can.Message(
+            arbitration_id=self.sdo_tx,
+            data=struct.pack('<BHB4x', 0x40, 0x1F51, 0x01),
+            is_extended_id=False
+        )
+        self._status_request = can.Message(
+            arbitration_id=self.sdo_tx,
+            data=struct.pack('<BHB4x', 0x40, 0x1F57, 0x01),
+            is_extended_id=False
+        )
+        
+        # (data, segment frames, raw can_frames or None) from prepare_upload()
+        self._prepared: Optional[Tuple[bytes, memoryview, Optional[memoryview]]] = None
+        
+        # Waits on the raw ACK socket also watch this pipe, which cancel()
+        # writes to; the readers' stop() cannot wake a blocked socket
+        self._wake_r, self._wake_w = os.pipe()
+    
+    @staticmethod
+    def _noop(*args) -> None:
+        """Progress sink used when no callback is registered."""
+    
+    def close(self) -> None:
+        """Stop the background receive thread. The bus itself is left open."""
+        self._notifier.stop()
+        if self._wake_w >= 0:
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            self._wake_r = self._wake_w = -1
+    
+    def cancel(self) -> None:
+        """
+        Abort the operation in progress from another thread.
+        
+        Any pending response wait returns immediately and every later one
+        fails at once, so the running transfer stops without retransmitting.
+        Safe to call from a signal handler; has no effect after close().
+        """
+        self._reader.stop()
+        self._heartbeats.stop()
+        if self._wake_w >= 0:
+            os.write(self._wake_w, b'\0')
+    
+    @property
+    def cancelled(self) -> bool:
+        """True once cancel() has been called."""
+        return self._reader.is_stopped
+    
+    def _drain_rx(self, reader: Optional[can.BufferedReader] = None) -> None:
+        """Discard everything queued on a reader (the SDO reader by default)."""
+        if reader is None:
+            reader = self._reader
+        while reader.get_message(timeout=0.0) is not None:
+            pass
+    
+    def _await_sdo_response(self, timeout: float) -> Optional[can.Message]:
+        """
+        Wait for the next SDO response from this node.
+        
+        Heartbeats and other nodes' frames never reach the reader, so the
+        first queued message is the answer.
+        
+        Returns:
+            The response message, or None on timeout
+        """
+        return self._reader.get_message(timeout=timeout)
+    
     def set_program(self, program: int) -> bool:
         """
         Control bootloader/application mode via CANopen SDO.
@@ -53,44 +230,192 @@ class FirmwareUpdater:
         Returns:
             True if successful, False otherwise
         """
-        print(f"[SetProgram] Writing {program} to SDO 0x1F51:01 (8017:1)")
+        print(f"[SetProgram] Writing {program} to SDO 0x1F51:01 (8017:1)", flush=True)
+        
+        # Discard stale responses (e.g. a late answer to an earlier request)
+        self._drain_rx()
         
         # Write 1 byte to SDO 0x1F51:01
         # Command: 0x2F = write 1 byte expedited
-        msg = can.Message(
-            arbitration_id=self.sdo_tx,
-            data=[0x2F, 0x51, 0x1F, 0x01, program, 0x00, 0x00, 0x00],
-            is_extended_id=False
-        )
-        self.bus.send(msg)
+        self._program_request.data[4] = program
+        self.bus.send(self._program_request)
         
         # Wait for response
-        response = self.bus.recv(timeout=2.0)
-        if response and response.arbitration_id == self.sdo_rx:
+        response = self._await_sdo_response(timeout=2.0)
+        if response:
             if response.data[0] == 0x60:  # Write OK
-                print(f"[SetProgram] ✓ SDO Write confirmed")
+                print(f"[SetProgram] ✓ SDO Write confirmed", flush=True)
                 return True
             elif response.data[0] == 0x80:  # Abort
-                abort_code = struct.unpack('<I', response.data[4:8])[0]
-                print(f"[SetProgram] ✗ SDO Abort: 0x{abort_code:08X}")
+                abort_code = int.from_bytes(response.data[4:8], 'little')
+                print(f"[SetProgram] ✗ SDO Abort: 0x{abort_code:08X}", flush=True)
                 return False
         
-        print(f"[SetProgram] ✗ No response")
+        print(f"[SetProgram] ✗ No response", flush=True)
         return False
     
-    def program_firmware(self, firmware_data: bytes) -> bool:
+    def get_program(self) -> Optional[int]:
+        """
+        Read the current Program Control value (SDO 0x1F51:01).
+        
+        Returns:
+            0 in the bootloader, 1 in the application, or None if the read fails
+        """
+        return self._sdo_read(self._program_read_request)[0]
+    
+    def change_program(self, program: int, timeout: float = 10.0) -> bool:
+        """
+        Switch between bootloader and application and wait until it is running.
+        
+        The Program Control write is retransmitted with exponential backoff
+        until the device confirms it (or reboots without answering). The
+        bootup heartbeat on 0x700+node then marks the restart, and reading
+        0x1F51:01 back confirms the requested program is active. Without a
+        bootup (no heartbeats, or no restart needed) the program is read back
+        after BOOTUP_FALLBACK seconds. Devices that abort that read are taken
+        at their word once the write was confirmed and they booted or the
+        fallback delay passed; only a different value read back fails.
+        
+        Args:
+            program: 0 for bootloader, 1 for application
+            timeout: Maximum time for the whole switch
+            
+        Returns:
+            True if the device runs the requested program, False otherwise
+        """
+        if self.get_program() == program:
+            # e.g. recovering a device that is already stuck in its bootloader
+            print(f"[ChangeProgram] ✓ Program {program} already running", flush=True)
+            return True
+        
+        print(f"[ChangeProgram] Writing {program} to SDO 0x1F51:01 (8017:1)", flush=True)
+        
+        # Only a bootup sent after this write proves a restart
+        self._drain_rx(self._heartbeats)
+        
+        def running() -> bool:
+            value, abort_code = self._sdo_read(self._program_read_request)
+            return value == program or abort_code is not None
+        
+        self._program_request.data[4] = program
+        confirmed = booted = False
+        fallback_at = 0.0
+        attempt = 0
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.cancelled:
+                break
+            delay = min(self.PROGRAM_RETRY * 1.5 ** attempt, self.PROGRAM_RETRY_MAX, remaining)
+            attempt += 1
+            
+            if not (confirmed or booted):
+                self._drain_rx()
+                self.bus.send(self._program_request)
+                response = self._await_sdo_response(timeout=delay)
+                if response is not None:
+                    if response.data[0] == 0x60:
+                        print(f"[ChangeProgram] ✓ SDO Write confirmed", flush=True)
+                        confirmed = True
+                        fallback_at = time.monotonic() + self.BOOTUP_FALLBACK
+                    elif response.data[0] == 0x80:
+                        abort_code = int.from_bytes(response.data[4:8], 'little')
+                        print(f"[ChangeProgram] ✗ SDO Abort: 0x{abort_code:08X}", flush=True)
+                        return False
+                heartbeat = self._heartbeats.get_message(timeout=0.0)
+            else:
+                heartbeat = self._heartbeats.get_message(timeout=delay)
+            
+            while heartbeat is not None:
+                if not booted and heartbeat.data[:1] == b'\x00':
+                    print(f"[ChangeProgram] ✓ Bootup received", flush=True)
+                    booted = True
+                heartbeat = self._heartbeats.get_message(timeout=0.0)
+            
+            # Without a bootup, read the program back once the device had
+            # time to restart
+            if booted or (confirmed and time.monotonic() >= fallback_at):
+                if running():
+                    return True
+        
+        # Devices without heartbeats (or that need no restart) never send a bootup
+        if confirmed and not booted and running():
+            return True
+        
+        print(f"[ChangeProgram] ✗ Program {program} not running after {timeout:.0f} seconds", flush=True)
+        return False
+    
+    def _sdo_read(self, request: can.Message,
+                  timeout: float = 1.0) -> Tuple[Optional[int], Optional[int]]:
+        """
+        Send a pre-built SDO upload request and decode the expedited answer.
+        
+        Returns:
+            Tuple of (value, abort_code). value is None on timeout, abort or a
+            non-expedited answer; abort_code is only set if the device aborted
+        """
+        # Discard stale responses (e.g. a late answer to the previous poll)
+        self._drain_rx()
+        
+        self.bus.send(request)
+        response = self._await_sdo_response(timeout=timeout)
+        if not response:
+            return None, None
+        
+        cmd = response.data[0]
+        if cmd == 0x80:
+            return None, int.from_bytes(response.data[4:8], 'little')
+        if (cmd & 0xE2) != 0x42:  # Expedited upload response (0x4F = 1 byte ... 0x43 = 4 bytes)
+            return None, None
+        size = 4 - ((cmd >> 2) & 0x03) if cmd & 0x01 else 4
+        return int.from_bytes(response.data[4:4 + size], 'little'), None
+    
+    def prepare_upload(self, firmware_data: bytes) -> None:
+        """
+        Build every download frame for firmware_data ahead of time.
+        
+        Call this before entering the bootloader so the device is not kept
+        waiting while frames are assembled; program_firmware() reuses them
+        when it is passed the same object.
+        """
+        frames = memoryview(_build_segment_frames(firmware_data))
+        raw_frames = None
+        if getattr(self.bus, 'socket', None) is not None:
+            raw_frames = memoryview(_pack_socketcan_frames(self.sdo_tx, frames))
+        self._prepared = (firmware_data, frames, raw_frames)
+    
+    def _prepared_frames(self, data: bytes) -> Tuple[memoryview, Optional[memoryview]]:
+        """Return (frames, raw_frames) for data, building them if not prepared."""
+        if self._prepared is None or self._prepared[0] is not data:
+            self.prepare_upload(data)
+        assert self._prepared is not None
+        return self._prepared[1], self._prepared[2]
+    
+    def program_firmware(self, firmware_data: bytes, block: bool = False) -> bool:
         """
         Upload firmware to device bootloader via CANopen SDO segmented download.
         
-        Writes firmware data to SDO 0x1F50:01 using CANopen segmented download.
+        Writes firmware data to SDO 0x1F50:01 using CANopen segmented download,
+        or block download if requested. Block download falls back to segmented
+        if the device does not support block transfers.
         
         Args:
-            firmware_data: Complete firmware file contents (Intel HEX ASCII format)
+            firmware_data: Complete firmware file contents (Intel HEX ASCII format),
+                or the parsed binary image if the bootloader accepts binary
+            block: Try SDO block download first
             
         Returns:
             True if upload successful, False otherwise
         """
         print(f"[ProgramFirmware] Uploading {len(firmware_data)} bytes to SDO 0x1F50:01 (8016:1)")
+        
+        if block:
+            print(f"[ProgramFirmware] Transfer mode: Block")
+            result = self._sdo_block_download(0x1F50, 0x01, firmware_data, timeout=5.0)
+            if result is not None:
+                return result
+            print(f"[ProgramFirmware] Block download not supported, falling back to segmented")
+        
         print(f"[ProgramFirmware] Transfer mode: Segmented (NoBlock)")
         print(f"[ProgramFirmware] Timeout: 30000ms")
         
@@ -104,132 +429,313 @@ class FirmwareUpdater:
         """
         # Clear receive queue first
         print(f"[SDO] Clearing receive queue...")
-        while self.bus.recv(timeout=0.01):
-            pass
+        self._drain_rx()
         
         # Step 1: Initiate Download (size indicated)
         # Command: 0x21 = download initiate, size indicated
-        size_bytes = struct.pack('<I', len(data))
         msg = can.Message(
             arbitration_id=self.sdo_tx,
-            data=[0x21, index & 0xFF, (index >> 8) & 0xFF, subindex] + list(size_bytes),
+            data=struct.pack('<BHBI', 0x21, index, subindex, len(data)),
             is_extended_id=False
         )
         self.bus.send(msg)
-        print(f"[SDO] Initiate download: {len(data)} bytes to 0x{index:04X}:{subindex}")
+        print(f"[SDO] Initiate download: {len(data)} bytes to 0x{index:04X}:{subindex}", flush=True)
         
-        # Wait for initiate response with proper filtering
-        start_time = time.time()
-        while time.time() - start_time < 5.0:
-            response = self.bus.recv(timeout=0.5)
+        # Wait for initiate response, skipping anything but a confirm or abort
+        deadline = time.monotonic() + 5.0
+        while True:
+            response = self._await_sdo_response(timeout=max(deadline - time.monotonic(), 0.0))
             if not response:
-                continue
-            # Only process messages from our node
-            if response.arbitration_id != self.sdo_rx:
-                continue
-            # Only process messages from our node
-            if response.arbitration_id != self.sdo_rx:
-                continue
+                print(f"[SDO] ✗ Initiate timeout after 5 seconds")
+                return False
             
             if response.data[0] == 0x80:
-                abort_code = struct.unpack('<I', response.data[4:8])[0]
+                abort_code = int.from_bytes(response.data[4:8], 'little')
                 print(f"[SDO] ✗ Initiate abort: 0x{abort_code:08X}")
                 return False
             if response.data[0] != 0x60:
                 print(f"[SDO] ✗ Unexpected initiate response: 0x{response.data[0]:02X}")
                 continue  # Keep waiting
             
-            print(f"[SDO] ✓ Download initiated")
+            print(f"[SDO] ✓ Download initiated", flush=True)
             break
-        else:
-            print(f"[SDO] ✗ Initiate timeout after 5 seconds")
-            return False
         
         # Step 2: Send segments
-        offset = 0
-        toggle = 0
-        segment_num = 0
-        last_progress = 0
-        start_time = time.time()
+        frames, raw_frames = self._prepared_frames(data)
+        sock = getattr(self.bus, 'socket', None)
+        if sock is not None and raw_frames is not None:
+            # SocketCAN: every segment is pre-packed as a kernel can_frame and
+            # written straight to the raw socket, bypassing python-can on the
+            # hot path
+            def send_segment(num: int) -> None:
+                sock.send(raw_frames[num * 16:num * 16 + 16])
+            
+            # ACKs likewise come straight from a second raw socket that the
+            # kernel filters down to our SDO responses
+            try:
+                ack_sock = _open_raw_can_socket(getattr(self.bus, 'channel'), self.sdo_rx)
+            except (OSError, AttributeError):
+                ack_sock = None
+        else:
+            ack_sock = None
+            # One message object is reused for every segment; only its payload
+            # is swapped for the next ready-made 8-byte frame. bus.send()
+            # serializes the frame before returning.
+            segments = [bytearray(frames[i:i + 8]) for i in range(0, len(frames), 8)]
+            tx_msg = can.Message(arbitration_id=self.sdo_tx, data=bytes(8), is_extended_id=False)
+            
+            def send_segment(num: int) -> None:
+                tx_msg.data = segments[num]
+                self.bus.send(tx_msg)
         
-        while offset < len(data):
-            # Get segment data (7 bytes max)
-            segment_data = data[offset:offset+7]
-            bytes_in_segment = len(segment_data)
-            is_last = (offset + bytes_in_segment >= len(data))
+        n_seg = len(frames) // 8
+        # The expected ACK is fully determined by the pre-built command byte:
+        # scs 1 plus the same toggle bit (bit 4). Map the whole command column
+        # at once so nothing is left to compute between ACK and next send.
+        # ACKs are compared without their reserved low nibble.
+        expected_acks = bytes(frames[0::8]).translate(_SEGMENT_ACK)
+        # Bound once outside the loop: saves attribute lookups per segment
+        reader = self._reader
+        if ack_sock is not None:
+            ack_fd = ack_sock.fileno()
+            wake = self._wake_r
             
-            # Build command byte
-            # Bit 4: toggle (0 or 1)
-            # Bit 0: last segment flag
-            # Bits 1-3: number of bytes that do NOT contain data (7 - bytes_in_segment)
-            cmd = (toggle << 4)
-            if is_last:
-                cmd |= 0x01
-            n = 7 - bytes_in_segment
-            cmd |= (n << 1)
+            def await_response(wait: float) -> Optional[bytes]:
+                if reader.is_stopped:
+                    return None
+                ready, _, _ = select.select([ack_fd, wake], [], [], wait)
+                if ack_fd not in ready:  # Timeout, or woken by cancel()
+                    return None
+                return ack_sock.recv(16)[8:]
+        else:
+            def await_response(wait: float) -> Optional[bytes]:
+                response = reader.get_message(timeout=wait)
+                return bytes(response.data) if response is not None else None
+        notify = self._notify
+        attempts = self.segment_attempts
+        base_timeout = self.segment_timeout
+        # A first wait above the cap is kept as-is rather than cut down
+        max_timeout = max(self.SEGMENT_TIMEOUT_MAX, base_timeout)
+        last_progress = 0
+        # Byte offset at which the next 10% step is reached, so the loop only
+        # does an integer compare until there is something to print
+        next_report = -(-len(data) * 10 // 100)
+        stale_ack = None
+        start_time = time.monotonic()
+        last_report_time = start_time
+        
+        try:
+            if ack_sock is not None:
+                # Otherwise the notifier would decode and queue every ACK again
+                self.bus.set_filters([self._heartbeat_filter])
             
-            # Pad to 7 bytes
-            segment_data = segment_data + bytes([0] * (7 - len(segment_data)))
+            for segment_num in range(n_seg):
+                expected_ack = expected_acks[segment_num]
+                
+                # Send pre-built segment and wait for its ACK (heartbeats are
+                # dropped by the reader). On timeout the same frame is resent: the
+                # server has not seen it, so its toggle bit has not advanced.
+                # Aborts are never retried.
+                ack = None
+                for attempt in range(attempts):
+                    if attempt:
+                        print(f"[SDO] Segment {segment_num} timeout, retransmitting (attempt {attempt + 1})",
+                              flush=True)
+                    send_segment(segment_num)
+                    wait = min(base_timeout * 2 ** attempt, max_timeout)
+                    ack = await_response(wait)
+                    if ack and ack[0] & 0xF0 == stale_ack:
+                        # Late duplicate ACK for the previously retransmitted segment
+                        stale_ack = None
+                        ack = await_response(wait)
+                    if ack or reader.is_stopped:
+                        break
+                stale_ack = expected_ack if attempt else None
+                
+                if not ack:
+                    if reader.is_stopped:
+                        print(f"[SDO] ✗ Cancelled at segment {segment_num}")
+                    else:
+                        print(f"[SDO] ✗ Segment {segment_num} timeout (no SDO response)")
+                    return False
+                
+                if ack[0] & 0xF0 != expected_ack:
+                    if ack[0] == 0x80:
+                        abort_code = int.from_bytes(ack[4:8], 'little')
+                        print(f"[SDO] ✗ Segment {segment_num} abort: 0x{abort_code:08X}")
+                    elif (ack[0] & 0xE0) != 0x20:
+                        print(f"[SDO] ✗ Unexpected segment response: 0x{ack[0]:02X}")
+                    else:
+                        print(f"[SDO] ✗ Toggle bit mismatch at segment {segment_num}")
+                    return False
+                
+                # Progress reporting
+                offset = min((segment_num + 1) * 7, len(data))
+                if offset >= next_report:
+                    now = time.monotonic()
+                    if now - last_report_time < self.PROGRESS_INTERVAL and offset < len(data):
+                        continue
+                    last_report_time = now
+                    progress = offset * 100 // len(data)
+                    elapsed = now - start_time
+                    rate = offset / elapsed if elapsed > 0 else 0
+                    print(f"[SDO] {progress}% ({offset}/{len(data)} bytes, {rate:.0f} B/s)", flush=True)
+                    notify(offset, len(data))
+                    last_progress = progress
+                    # Clamped so the final segment always reports 100%
+                    next_report = min(-(-len(data) * (last_progress + 10) // 100), len(data))
             
-            # Send segment
-            msg = can.Message(
-                arbitration_id=self.sdo_tx,
-                data=[cmd] + list(segment_data),
-                is_extended_id=False
-            )
-            self.bus.send(msg)
+            print(f"[SDO] ✓ Upload complete ({n_seg} segments)")
+            return True
+        finally:
+            if ack_sock is not None:
+                ack_sock.close()
+                self.bus.set_filters([self._sdo_filter, self._heartbeat_filter])
+    
+    def _sdo_block_download(self, index: int, subindex: int, data: bytes, timeout: float = 5.0) -> Optional[bool]:
+        """
+        CANopen SDO Block Download protocol implementation (CiA 301).
+        
+        Sends up to blksize 7-byte segments (as chosen by the server) before
+        waiting for a single block acknowledge, instead of one ACK per segment.
+        
+        Returns:
+            True if successful, False on failure, None if the server does not
+            support block transfer (caller may fall back to segmented)
+        """
+        self._drain_rx()
+        
+        # Step 1: Initiate Block Download
+        # Command: 0xC6 = ccs 6, CRC supported, size indicated, cs 0 (initiate)
+        msg = can.Message(
+            arbitration_id=self.sdo_tx,
+            data=struct.pack('<BHBI', 0xC6, index, subindex, len(data)),
+            is_extended_id=False
+        )
+        self.bus.send(msg)
+        print(f"[SDO-Block] Initiate block download: {len(data)} bytes to 0x{index:04X}:{subindex}", flush=True)
+        
+        response = self._await_sdo_response(timeout=timeout)
+        if not response:
+            # Some bootloaders silently ignore command specifiers they lack
+            print(f"[SDO-Block] ✗ No initiate response")
+            return None
+        if response.data[0] == 0x80:
+            abort_code = int.from_bytes(response.data[4:8], 'little')
+            print(f"[SDO-Block] ✗ Initiate abort: 0x{abort_code:08X}")
+            # 0x05040001: command specifier not valid or unknown, i.e. no
+            # block transfer support. Any other abort would hit segmented too.
+            return None if abort_code == 0x05040001 else False
+        if (response.data[0] & 0xE3) != 0xA0:
+            print(f"[SDO-Block] ✗ Unexpected initiate response: 0x{response.data[0]:02X}")
+            return False
+        blksize = response.data[4]
+        server_crc = bool(response.data[0] & 0x04)
+        print(f"[SDO-Block] ✓ Block download initiated (blksize {blksize}, CRC {'on' if server_crc else 'off'})", flush=True)
+        
+        # Step 2: Send sub-blocks, each followed by one block acknowledge
+        # Reuse the segmented frame layout: payload bytes 1-7 are identical,
+        # only the command byte is replaced by the sequence number
+        frames, _ = self._prepared_frames(data)
+        n_seg = len(frames) // 8
+        tx_data = bytearray(8)
+        tx_msg = can.Message(arbitration_id=self.sdo_tx, data=tx_data, is_extended_id=False)
+        tx_batch = self.tx_batch
+        tx_batch_delay = self.tx_batch_delay
+        segment_num = 0
+        stalled = 0
+        last_progress = 0
+        start_time = time.monotonic()
+        last_report_time = start_time
+        
+        while segment_num < n_seg:
+            if not 1 <= blksize <= 127:
+                print(f"[SDO-Block] ✗ Invalid block size {blksize}")
+                return False
             
-            # Wait for segment response - filter out heartbeats (0x701)
-            response = None
-            start_wait = time.time()
-            while time.time() - start_wait < 2.0:  # 2 second timeout per segment
-                msg = self.bus.recv(timeout=0.1)
-                if not msg:
-                    continue
-                # Skip heartbeat messages
-                if msg.arbitration_id == 0x700 + self.node_id:
-                    continue
-                # Check for SDO response
-                if msg.arbitration_id == self.sdo_rx:
-                    response = msg
-                    break
+            sent = min(blksize, n_seg - segment_num)
+            for seqno in range(1, sent + 1):
+                seg = segment_num + seqno - 1
+                tx_data[:] = frames[seg * 8:seg * 8 + 8]
+                # Bit 7: no more segments; bits 0-6: sequence number in block
+                tx_data[0] = _BLOCK_SEGMENT_CMD[seqno + (seg == n_seg - 1) * 128]
+                self.bus.send(tx_msg)
+                # Pace the sub-block so small adapter/driver TX FIFOs can drain
+                if tx_batch_delay and seqno % tx_batch == 0 and seqno < sent:
+                    time.sleep(tx_batch_delay)
             
+            response = self._await_sdo_response(timeout=timeout)
             if not response:
-                print(f"[SDO] ✗ Segment {segment_num} timeout (no SDO response)")
+                print(f"[SDO-Block] ✗ Block acknowledge timeout at segment {segment_num}")
                 return False
-            
             if response.data[0] == 0x80:
-                abort_code = struct.unpack('<I', response.data[4:8])[0]
-                print(f"[SDO] ✗ Segment {segment_num} abort: 0x{abort_code:08X}")
+                abort_code = int.from_bytes(response.data[4:8], 'little')
+                print(f"[SDO-Block] ✗ Block abort: 0x{abort_code:08X}")
                 return False
-            
-            # Verify response toggle bit
-            if (response.data[0] & 0xE0) != 0x20:
-                print(f"[SDO] ✗ Unexpected segment response: 0x{response.data[0]:02X}")
+            if response.data[0] != 0xA2:
+                print(f"[SDO-Block] ✗ Unexpected block response: 0x{response.data[0]:02X}")
                 return False
             
-            response_toggle = (response.data[0] >> 4) & 0x01
-            if response_toggle != toggle:
-                print(f"[SDO] ✗ Toggle bit mismatch at segment {segment_num}")
-                return False
-            
-            # Update progress
-            offset += bytes_in_segment
-            toggle = 1 - toggle
-            segment_num += 1
+            # Server reports the last sequence number received in order;
+            # anything after it is sent again in the next sub-block
+            ackseq = response.data[1]
+            blksize = response.data[2]
+            if ackseq == 0:
+                stalled += 1
+                if stalled >= self.segment_attempts:
+                    print(f"[SDO-Block] ✗ No progress after {stalled} sub-blocks at segment {segment_num}")
+                    # Abort 0x05040003: invalid sequence number (block mode only)
+                    self.bus.send(can.Message(
+                        arbitration_id=self.sdo_tx,
+                        data=struct.pack('<BHBI', 0x80, index, subindex, 0x05040003),
+                        is_extended_id=False
+                    ))
+                    return False
+            else:
+                stalled = 0
+            segment_num += min(ackseq, sent)
             
-            # Progress reporting
+            offset = min(segment_num * 7, len(data))
             progress = int((offset / len(data)) * 100)
-            if progress >= last_progress + 10 or is_last:
-                elapsed = time.time() - start_time
+            now = time.monotonic()
+            if (progress >= last_progress + 10 and now - last_report_time >= self.PROGRESS_INTERVAL
+                    or segment_num == n_seg):
+                last_report_time = now
+                elapsed = now - start_time
                 rate = offset / elapsed if elapsed > 0 else 0
-                print(f"[SDO] {progress}% ({offset}/{len(data)} bytes, {rate:.0f} B/s)")
+                print(f"[SDO-Block] {progress}% ({offset}/{len(data)} bytes, {rate:.0f} B/s)", flush=True)
+                self._notify(offset, len(data))
                 last_progress = progress
         
-        print(f"[SDO] ✓ Upload complete ({segment_num} segments)")
+        # Step 3: End Block Download
+        # Command: 0xC1 | n << 2, n = bytes in the last segment without data.
+        # CRC-16-CCITT (poly 0x1021, init 0) over the payload; crc_hqx is the
+        # same CRC computed in C.
+        n = n_seg * 7 - len(data)
+        crc = binascii.crc_hqx(data, 0) if server_crc else 0
+        msg = can.Message(
+            arbitration_id=self.sdo_tx,
+            data=struct.pack('<BH5x', 0xC1 | (n << 2), crc),
+            is_extended_id=False
+        )
+        self.bus.send(msg)
+        
+        response = self._await_sdo_response(timeout=timeout)
+        if not response:
+            print(f"[SDO-Block] ✗ End block timeout")
+            return False
+        if response.data[0] == 0x80:
+            abort_code = int.from_bytes(response.data[4:8], 'little')
+            print(f"[SDO-Block] ✗ End block abort: 0x{abort_code:08X}")
+            return False
+        if response.data[0] != 0xA1:
+            print(f"[SDO-Block] ✗ Unexpected end block response: 0x{response.data[0]:02X}")
+            return False
+        
+        print(f"[SDO-Block] ✓ Upload complete ({n_seg} segments)")
         return True
     
-    def get_firmware_status(self) -> Optional[tuple]:
+    def get_firmware_status(self) -> Optional[Tuple[str, int]]:
         """
         Read firmware update status from device.
         
@@ -242,165 +748,605 @@ class FirmwareUpdater:
         Bit 0: Status (0=OK/Error, 1=Busy)
         
         Returns:
-            Tuple of (status_string, error_code) or None if read fails
+            Tuple of (status_string, error_code), ("Unsupported", abort_code)
+            if the device aborts the read, or None if it does not answer
         """
         # Read SDO 0x1F57:01
-        msg = can.Message(
-            arbitration_id=self.sdo_tx,
-            data=[0x40, 0x57, 0x1F, 0x01, 0x00, 0x00, 0x00, 0x00],
-            is_extended_id=False
-        )
-        self.bus.send(msg)
-        
-        response = self.bus.recv(timeout=1.0)
-        if not response or response.arbitration_id != self.sdo_rx:
+        value, abort_code = self._sdo_read(self._status_request)
+        if abort_code is not None:
+            return ("Unsupported", abort_code)
+        if value is None:
             return None
         
-        if response.data[0] == 0x4F:  # 1-byte upload response
-            value = response.data[4]
-            status_bit = value & 1
-            
-            if status_bit == 0:  # OK or Error
-                error_code = (value >> 8) & 0x7F
-                if error_code > 0:
-                    return ("Error", error_code)
-                return ("Ok", 0)
-            elif status_bit == 1:  # Busy
-                return ("Busy", 0)
+        status_bit = value & 1
+        if status_bit == 0:  # OK or Error
+            error_code = (value >> 8) & 0x7F
+            if error_code > 0:
+                return ("Error", error_code)
+            return ("Ok", 0)
+        return ("Busy", 0)
+    
+    def wait_for_verification(self, timeout: float = 60.0, interval: float = 0.5) -> Optional[Tuple[str, int]]:
+        """
+        Poll the firmware status until the device is no longer busy.
         
+        Returns:
+            Final (status_string, error_code) tuple (see get_firmware_status();
+            an abort ends polling at once), or None if the device never
+            reported a completed status before the timeout
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and not self.cancelled:
+            status = self.get_firmware_status()
+            if status and status[0] != "Busy":
+                return status
+            time.sleep(interval)
         return None
 
 
-def parse_intel_hex(hex_file: str) -> bytes:
-    """Parse Intel HEX file to binary"""
-    data = bytearray()
+def _build_segment_frames(data: bytes) -> bytearray:
+    """
+    Pre-build all SDO download segment frames into one contiguous buffer.
+    
+    Each segment occupies 8 bytes: the command byte followed by 7 data
+    bytes (zero padded on the last segment). Command byte layout:
+    - Bit 4: toggle (alternates 0, 1, 0, ...)
+    - Bits 1-3: number of bytes that do NOT contain data
+    - Bit 0: last segment flag
+    """
+    n_seg = (len(data) + 6) // 7
+    if n_seg == 0:
+        return bytearray()
+    
+    # The buffer starts zeroed, so the last segment's padding comes for free
+    frames = bytearray(n_seg * 8)
+    view = memoryview(data)
+    n_full = len(data) // 7
+    
+    # Scatter the payload with seven strided copies instead of one slice per
+    # segment; strided memoryview slices avoid copying the input first
+    for i in range(7):
+        frames[1 + i:n_full * 8:8] = view[i:n_full * 7:7]
+    frames[n_full * 8 + 1:n_full * 8 + 1 + len(data) - n_full * 7] = view[n_full * 7:]
+    
+    frames[0::8] = (b'\x00\x10' * ((n_seg + 1) // 2))[:n_seg]
+    tail = len(data) - (n_seg - 1) * 7
+    frames[-8] |= 0x01 | ((7 - tail) << 1)
+    return frames
+
+
+# Segment command byte -> expected download segment response byte
+_SEGMENT_ACK = bytes(0x20 | (cmd & 0x10) for cmd in range(256))
+
+# Block download segment command byte, indexed by seqno + 128 * last_segment
+_BLOCK_SEGMENT_CMD = bytes(range(128)) + bytes(0x80 | seqno for seqno in range(128))
+
+# struct can_frame header from <linux/can.h>: can_id, len, flags, pad, len8_dlc
+_CAN_FRAME_HEADER = struct.Struct('=IBB1xB')
+
+
+def _open_raw_can_socket(channel: str, can_id: int) -> socket.socket:
+    """Open a raw SocketCAN socket on channel that only receives can_id frames."""
+    sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+    try:
+        sock.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_FILTER,
+                        struct.pack('=II', can_id, socket.CAN_SFF_MASK))
+        sock.bind((channel,))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _pack_socketcan_frames(can_id: int, frames: Union[bytes, memoryview]) -> bytearray:
+    """
+    Pack pre-built 8-byte segment frames into SocketCAN can_frame structs.
+    
+    Produces 16 bytes per frame (8-byte header + 8 data bytes), ready to be
+    written to a raw CAN socket one struct at a time.
+    """
+    n_frames = len(frames) // 8
+    header = _CAN_FRAME_HEADER.pack(can_id, 8, 0, 8)
+    raw = bytearray(n_frames * 16)
+    for i in range(8):
+        raw[i::16] = header[i:i + 1] * n_frames
+        raw[8 + i::16] = frames[i::8]
+    return raw
+
+
+# Form every non-blank line must have, without surrounding whitespace
+_HEX_RECORD = re.compile(rb':([0-9A-Fa-f]+)')
+
+
+def parse_intel_hex(hex_file: str, strict: bool = False) -> bytes:
+    """
+    Parse Intel HEX file to binary.
+    
+    Every record's checksum is verified. Malformed records and lines that are
+    not records at all are skipped with a warning, or raise ValueError when
+    strict is set (also raised if the file has no data or no end-of-file
+    record).
+    """
+    chunks = []
     extended_addr = 0
-    base_address = None
+    end_of_file = False
     
-    with open(hex_file, 'r') as f:
-        for line_num, line in enumerate(f, 1):
-            line = line.strip()
-            if not line or not line.startswith(':'):
-                continue
+    with open(hex_file, 'rb') as f:
+        content = f.read()
+    
+    def report(line_num, error):
+        if strict:
+            raise ValueError(f"Line {line_num}: {error}")
+        print(f"Warning: Line {line_num}: {error}")
+    
+    # splitlines() accepts LF, CRLF and CR-only line endings alike
+    records = []
+    for line_num, line in enumerate(content.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        record = _HEX_RECORD.fullmatch(line)
+        if record is None:
+            report(line_num, "Not an Intel HEX record")
+            continue
+        if len(record.group(1)) % 2:
+            report(line_num, "Odd number of hex digits")
+            continue
+        records.append((line_num, record.group(1)))
+    
+    # Decode every record of the file in a single C call, then walk the
+    # decoded buffer record by record through zero-copy memoryview slices
+    decoded = memoryview(binascii.unhexlify(b''.join(digits for _, digits in records)))
+    pos = 0
+    
+    for line_num, digits in records:
+        rec = decoded[pos:pos + len(digits) // 2]
+        pos += len(rec)
+        try:
+            byte_count = rec[0]
+            if len(rec) != byte_count + 5:
+                raise ValueError("Record length does not match its byte count")
+            if sum(rec) & 0xFF:
+                raise ValueError(f"Checksum mismatch (0x{rec[-1]:02X})")
+            address, = struct.unpack_from('>H', rec, 1)
+            record_type = rec[3]
             
-            try:
-                byte_count = int(line[1:3], 16)
-                address = int(line[3:7], 16)
-                record_type = int(line[7:9], 16)
-                
-                if record_type == 0x04:  # Extended Linear Address
-                    extended_addr = int(line[9:13], 16) << 16
-                elif record_type == 0x00:  # Data Record
-                    full_addr = extended_addr + address
-                    
-                    if base_address is None:
-                        base_address = full_addr
-                    
-                    offset = full_addr - base_address
-                    if offset + byte_count > len(data):
-                        data.extend([0xFF] * (offset + byte_count - len(data)))
-                    
-                    for i in range(byte_count):
-                        byte_val = int(line[9 + i*2:11 + i*2], 16)
-                        data[offset + i] = byte_val
-            except Exception as e:
-                print(f"Warning: Line {line_num}: {e}")
+            if record_type == 0x04:  # Extended Linear Address
+                extended_addr = struct.unpack_from('>H', rec, 4)[0] << 16
+            elif record_type == 0x02:  # Extended Segment Address
+                extended_addr = struct.unpack_from('>H', rec, 4)[0] << 4
+            elif record_type == 0x01:  # End Of File
+                end_of_file = True
+                break
+            elif record_type == 0x00:  # Data Record
+                chunks.append((extended_addr + address, rec[4:4 + byte_count]))
+        except (ValueError, struct.error) as e:
+            report(line_num, e)
+    
+    if strict and not end_of_file:
+        raise ValueError("Missing end-of-file record")
+    if strict and not chunks:
+        raise ValueError("No data records")
+    if not chunks:
+        return b''
+    
+    # The extent is known once all records are read: allocate the image once,
+    # pre-filled with erased-flash 0xFF, and copy each payload into place
+    base_address = min(addr for addr, _ in chunks)
+    end_address = max(addr + len(payload) for addr, payload in chunks)
+    data = bytearray(b'\xff') * (end_address - base_address)
+    for addr, payload in chunks:
+        offset = addr - base_address
+        data[offset:offset + len(payload)] = payload
     
     return bytes(data)
 
 
-def main():
-    if len(sys.argv) < 3:
-        print("Usage: update_firmware.py <node_id> <hex_file> [can_interface]")
-        print()
-        print("Arguments:")
-        print("  node_id        CANopen node ID (1-127)")
-        print("  hex_file       Path to Intel HEX firmware file")
-        print("  can_interface  SocketCAN interface (e.g., can0, vecan0). Default: can0")
-        print()
-        print("Examples:")
-        print("  python3 update_firmware.py 1 firmware.hex can0")
-        print("  python3 update_firmware.py 2 Epsilon_V2_v1.2.5.hex vecan0")
-        sys.exit(1)
+def tune_can_socket(bus: can.BusABC, sndbuf: int = 1 << 20, rcvbuf: int = 1 << 20,
+                    priority: int = 6) -> None:
+    """
+    Enlarge the kernel buffers of a SocketCAN bus and raise its priority.
     
-    node_id = int(sys.argv[1])
-    hex_file = sys.argv[2]
-    # Default to can0 if not provided
-    can_interface = sys.argv[3] if len(sys.argv) > 3 else 'can0'
+    Lets the kernel queue the next segment while the previous one is still
+    on the wire, and keeps bursts of responses from being dropped before
+    the receive thread gets to them. The socket priority puts firmware
+    frames ahead of other traffic queued on the same interface. Backends
+    without a raw socket are left untouched.
+    """
+    sock = getattr(bus, 'socket', None)
+    if sock is None:
+        return
+    options = [(socket.SO_SNDBUF, 'SO_SNDBUF', sndbuf),
+               (socket.SO_RCVBUF, 'SO_RCVBUF', rcvbuf)]
+    if hasattr(socket, 'SO_PRIORITY'):  # Linux only
+        options.append((socket.SO_PRIORITY, 'SO_PRIORITY', priority))
+    for option, name, value in options:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, value)
+        except OSError as e:
+            print(f"Warning: Could not set {name}: {e}")
+
+
+def _read_sysfs_link(interface: str) -> Optional[Tuple[int, int]]:
+    """Read (IFF flags, tx_queue_len) of an interface from sysfs, or None if unavailable."""
+    base = f'/sys/class/net/{interface}'
+    try:
+        with open(f'{base}/flags') as f:
+            flags = int(f.read(), 16)
+        with open(f'{base}/tx_queue_len') as f:
+            qlen = int(f.read())
+    except (OSError, ValueError):
+        return None
+    return flags, qlen
+
+
+def _has_net_admin() -> bool:
+    """True if this process may reconfigure network links (CAP_NET_ADMIN)."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('CapEff:'):
+                    return bool(int(line.split()[1], 16) & (1 << 12))  # CAP_NET_ADMIN
+    except (OSError, ValueError, IndexError):
+        pass
+    return os.geteuid() == 0
+
+
+def _set_txqueuelen(interface: str, txqueuelen: int) -> None:
+    """Lengthen an interface's TX queue with ip(8); failure only warns."""
+    command = ['ip', 'link', 'set', interface, 'txqueuelen', str(txqueuelen)]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True)
+    except OSError as e:
+        print(f"[CAN] ⚠ Could not set txqueuelen {txqueuelen}: {e}")
+        return
+    if result.returncode != 0:
+        print(f"[CAN] ⚠ Could not set txqueuelen {txqueuelen}: {result.stderr.strip()}")
+
+
+def _link_bitrate(link) -> Optional[int]:
+    """Bitrate from a pyroute2 link message, or None if it has no CAN bit timing."""
+    info = link.get_attr('IFLA_LINKINFO')
+    data = info.get_attr('IFLA_INFO_DATA') if info is not None else None
+    timing = data.get_attr('IFLA_CAN_BITTIMING') if data is not None else None
+    return timing.get('bitrate') if timing is not None else None
+
+
+def check_and_setup_can(interface: str, bitrate: int = 250000, txqueuelen: int = 1000,
+                        force: bool = False) -> bool:
+    """
+    Make sure a SocketCAN interface is up, configuring it if needed.
     
-    print("="*70)
-    print(f"FIRMWARE UPDATE - Node {node_id}")
-    print(f"File: {hex_file}")
-    print("="*70)
-    print()
+    With pyroute2 installed the link is queried over RTNETLINK in-process,
+    and an interface that is up at a different bitrate is reconfigured.
+    Without it, an interface that sysfs reports as up is accepted as-is
+    (sysfs does not show the bitrate), with the ip(8) command as fallback.
+    Configuring a link needs root or CAP_NET_ADMIN.
+    
+    The TX queue is lengthened as well, on a best-effort basis: SocketCAN
+    defaults to 10 frames, so back-to-back sends stall on a full qdisc.
+    Without CAP_NET_ADMIN this step is skipped silently.
     
+    Args:
+        interface: SocketCAN interface name (e.g. can0)
+        bitrate: Bitrate to configure if the interface is down
+        txqueuelen: Minimum TX queue length in frames
+        force: Take the link down and reconfigure it even if it is up
+        
+    Returns:
+        True if the interface is up, False otherwise
+    """
+    if not force and IPRoute is None:
+        # Fast path: two small sysfs reads, no fork/exec unless the TX queue
+        # still has to be lengthened
+        link = _read_sysfs_link(interface)
+        if link is not None and link[0] & _IFF_UP:
+            if link[1] < txqueuelen and _has_net_admin():
+                _set_txqueuelen(interface, txqueuelen)
+            return True
+    
+    if IPRoute is not None:
+        try:
+            with IPRoute() as ipr:
+                indices = ipr.link_lookup(ifname=interface)
+                if not indices:
+                    print(f"[CAN] ✗ Interface {interface} not found")
+                    return False
+                link = ipr.get_links(indices[0])[0]
+                if (link.get_attr('IFLA_TXQLEN') or 0) < txqueuelen and _has_net_admin():
+                    try:
+                        ipr.link('set', index=indices[0], txqlen=txqueuelen)
+                    except NetlinkError as e:
+                        print(f"[CAN] ⚠ Could not set txqueuelen {txqueuelen}: {e}")
+                if link['flags'] & _IFF_UP:
+                    # Virtual interfaces (vcan) have no bit timing at all
+                    current = _link_bitrate(link)
+                    if not force and current in (None, bitrate):
+                        return True
+                    if not force:
+                        print(f"[CAN] {interface} is up at {current} bit/s")
+                    ipr.link('set', index=indices[0], state='down')
+                
+                print(f"[CAN] Bringing up {interface} at {bitrate} bit/s", flush=True)
+                ipr.link('set', index=indices[0], kind='can', can_bittiming={'bitrate': bitrate})
+                ipr.link('set', index=indices[0], state='up')
+                return True
+        except (NetlinkError, OSError) as e:
+            print(f"[CAN] ✗ Could not configure {interface}: {e}")
+            return False
+    
+    try:
+        result = subprocess.run(['ip', 'link', 'show', interface], capture_output=True, text=True)
+        if result.returncode != 0:
+            print(f"[CAN] ✗ Interface {interface} not found")
+            return False
+        qlen = re.search(r'qlen (\d+)', result.stdout)
+        if qlen and int(qlen.group(1)) < txqueuelen and _has_net_admin():
+            _set_txqueuelen(interface, txqueuelen)
+        
+        # Match the UP flag itself, not e.g. the "state UP" or "LOWER_UP" text
+        flags = re.search(r'<([^>]*)>', result.stdout)
+        commands = [['ip', 'link', 'set', interface, 'type', 'can', 'bitrate', str(bitrate)],
+                    ['ip', 'link', 'set', interface, 'up']]
+        if flags and 'UP' in flags.group(1).split(','):
+            if not force:
+                return True
+            commands.insert(0, ['ip', 'link', 'set', interface, 'down'])
+        
+        print(f"[CAN] Bringing up {interface} at {bitrate} bit/s", flush=True)
+        for command in commands:
+            result = subprocess.run(command, capture_output=True, text=True)
+            if result.returncode != 0:
+                print(f"[CAN] ✗ {' '.join(command)}: {result.stderr.strip()}")
+                return False
+        return True
+    except OSError as e:
+        print(f"[CAN] ✗ Could not run ip: {e}")
+        return False
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Firmware updater for SuperB Epsilon V2 BMS modules (CANopen SDO).",
+        epilog=(
+            "Examples:\n"
+            "  python3 update_firmware.py 1 firmware.hex can0\n"
+            "  python3 update_firmware.py 2 Epsilon_V2_v1.2.5.hex vecan0"
+        ),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('node_id', type=int, help="CANopen node ID (1-127)")
+    parser.add_argument('hex_file', help="Path to Intel HEX firmware file")
+    parser.add_argument('can_interface', nargs='?', default='can0',
+                        help="SocketCAN interface (e.g., can0, vecan0). Default: can0")
+    
+    fmt = parser.add_mutually_exclusive_group()
+    fmt.add_argument('--ascii', dest='binary', action='store_false',
+                     help="Upload the Intel HEX text as-is (default)")
+    fmt.add_argument('--binary', dest='binary', action='store_true',
+                     help="Upload the parsed binary image instead of the HEX text "
+                          "(~half the CAN traffic; bootloader must accept binary)")
+    parser.add_argument('--block', action='store_true',
+                        help="Try SDO block download first (falls back to segmented if refused)")
+    parser.add_argument('--force-setup', action='store_true',
+                        help="Reconfigure the CAN interface (down, bitrate, up) even if it is already up")
+    parser.add_argument('--tx-batch', type=int, default=4,
+                        help="Block download: segments sent back-to-back before pausing. Default: 4")
+    parser.add_argument('--tx-batch-delay-ms', type=float, default=0.0,
+                        help="Block download: pause between batches in ms, for adapters that drop "
+                             "frames (0 = no pacing). Default: 0")
+    parser.add_argument('--frame-timeout-ms', type=float, default=FirmwareUpdater.SEGMENT_TIMEOUT * 1000,
+                        help="Segmented download: first wait for a segment ACK in ms, doubled on "
+                             "every retransmit. Default: 2000")
+    parser.add_argument('--retry-count', type=int, default=FirmwareUpdater.SEGMENT_ATTEMPTS,
+                        help="Segmented download: transmissions of a segment before giving up. Default: 4")
+    parser.add_argument('--reboot-window-s', type=float, default=10.0,
+                        help="Time allowed to enter the bootloader or start the application. Default: 10")
+    parser.add_argument('--expected-crc32', type=lambda x: int(x, 16), default=None,
+                        help="Refuse to flash unless the firmware file has this CRC-32 (hex)")
+    parser.set_defaults(binary=False)
+    return parser.parse_args(argv)
+
+
+def load_firmware(path: str, binary: bool = False,
+                  expected_crc32: Optional[int] = None) -> bytes:
+    """
+    Load and check an Intel HEX file, returning the bytes to upload.
+    
+    The file is uploaded as-is after a strict checksum pre-flight. With
+    binary set, the parsed image is returned instead of the HEX text.
+    
+    Raises:
+        ValueError: If the file is malformed or its CRC-32 does not match
+    """
     # Read firmware file AS-IS (ASCII text, not parsed!)
-    print("Loading firmware file...")
-    with open(hex_file, 'rb') as f:
+    with open(path, 'rb') as f:
         firmware_data = f.read()
     print(f"✓ Loaded {len(firmware_data)} bytes (Intel HEX ASCII format)")
-    print()
     
-    # Connect to CAN
-    print("Connecting to CAN bus...")
-    bus = can.Bus(interface='socketcan', channel=can_interface, bitrate=250000)
+    # Pre-flight: catch a corrupt file before spending minutes uploading it
+    try:
+        image = parse_intel_hex(path, strict=True)
+    except ValueError as e:
+        raise ValueError(f"Invalid Intel HEX file: {e}") from e
+    print(f"✓ Checksums verified ({len(image)} bytes of firmware image)")
+    
+    # Whole-file CRC-32 (same value as the crc32 tool prints); catches a wrong
+    # or damaged download before the device leaves its application
+    file_crc = zlib.crc32(firmware_data)
+    print(f"✓ File CRC-32: 0x{file_crc:08X}")
+    if expected_crc32 is not None and file_crc != expected_crc32:
+        raise ValueError(f"CRC-32 mismatch: expected 0x{expected_crc32:08X}")
+    
+    if binary:
+        # Only the data bytes go over the bus, not the ASCII record framing
+        print(f"✓ Uploading binary image ({len(image)} bytes)")
+        return image
+    return firmware_data
+
+
+def open_bus(can_interface: str, bitrate: int = 250000, force_setup: bool = False,
+             node_ids: Optional[List[int]] = None) -> can.BusABC:
+    """
+    Bring up a SocketCAN interface if needed and open a tuned bus on it.
+    
+    The bus can be shared by several run_update() calls (e.g. to flash a
+    whole pack); the caller shuts it down when done.
+    
+    Args:
+        can_interface: SocketCAN interface name (e.g. can0)
+        bitrate: Bitrate to configure if the interface is down
+        force_setup: Reconfigure the interface even if it is already up
+        node_ids: Nodes that will be updated; the kernel drops every other
+            frame from the moment the socket opens
+    """
+    if not check_and_setup_can(can_interface, bitrate=bitrate, force=force_setup):
+        print(f"⚠ Warning: {can_interface} may not be up; trying to connect anyway")
+    filters = [f for node_id in node_ids for f in node_filters(node_id)] if node_ids else None
+    bus = can.Bus(interface='socketcan', channel=can_interface, bitrate=bitrate,
+                  can_filters=filters)
+    tune_can_socket(bus)
     print(f"✓ Connected to {can_interface}")
-    print()
+    return bus
+
+
+def run_update(bus: can.BusABC, node_id: int, firmware_data: bytes, block: bool = False,
+               tx_batch: int = 4, tx_batch_delay: float = 0.0,
+               segment_timeout: float = FirmwareUpdater.SEGMENT_TIMEOUT,
+               segment_attempts: int = FirmwareUpdater.SEGMENT_ATTEMPTS,
+               reboot_window: float = 10.0) -> bool:
+    """
+    Run the full update sequence for one node on an open bus.
+    
+    Enters the bootloader, uploads firmware_data, waits for verification and
+    starts the application. The bus is left open for the next node.
+    reboot_window is the change_program() timeout for both mode switches;
+    the other keyword arguments are passed to FirmwareUpdater.
+    
+    Ctrl-C (when called from the main thread) cancels the running step, so
+    the transfer stops cleanly and the update is reported as failed; a
+    second Ctrl-C interrupts at once.
     
-    updater = FirmwareUpdater(bus, node_id)
+    Returns:
+        True if the update completed, False otherwise
+    """
+    updater = FirmwareUpdater(bus, node_id, tx_batch=tx_batch, tx_batch_delay=tx_batch_delay,
+                              segment_timeout=segment_timeout,
+                              segment_attempts=segment_attempts)
+    
+    def on_sigint(signum, frame) -> None:
+        signal.signal(signal.SIGINT, previous_sigint)
+        updater.cancel()
+    
+    try:
+        # None means a handler installed outside Python: fall back to the default
+        previous_sigint = signal.signal(signal.SIGINT, on_sigint) or signal.default_int_handler
+    except ValueError:  # Not the main thread: signals stay with the caller
+        previous_sigint = None
     
     try:
+        # Assemble all frames now, while the device still runs its application
+        updater.prepare_upload(firmware_data)
+        
         print("="*70)
         print("STEP 1: ENTER BOOTLOADER")
-        print("="*70)
-        if not updater.set_program(0):  # 0 = Bootloader
+        print("="*70, flush=True)
+        if not updater.change_program(0, timeout=reboot_window):  # 0 = Bootloader
             raise Exception("Failed to enter bootloader")
         print("✓ Bootloader mode activated")
-        print("Waiting 5 seconds for device to reboot...")
-        time.sleep(5)
         print()
         
         print("="*70)
         print("STEP 2: UPLOAD FIRMWARE")
-        print("="*70)
-        if not updater.program_firmware(firmware_data):
+        print("="*70, flush=True)
+        if not updater.program_firmware(firmware_data, block=block):
             raise Exception("Firmware upload failed")
         print("✓ Firmware uploaded successfully")
         print()
         
         print("="*70)
         print("STEP 3: VERIFICATION (Internal)")
-        print("="*70)
+        print("="*70, flush=True)
         print("Device is verifying firmware internally...")
-        print("This may take 30 seconds...")
-        time.sleep(30)
-        print("✓ Verification period complete")
+        print("Polling firmware status (up to 60 seconds)...", flush=True)
+        status = updater.wait_for_verification(timeout=60.0)
+        if status is None:
+            print("⚠ Warning: No completed status reported (device may not support 0x1F57)")
+        elif status[0] == "Unsupported":
+            # No status object to poll: give it the fixed verification period
+            print(f"⚠ Device does not report firmware status (SDO abort 0x{status[1]:08X})")
+            print("Waiting 30 seconds for verification...", flush=True)
+            time.sleep(30)
+        elif status[0] == "Error":
+            raise Exception(f"Device rejected firmware (error code {status[1]})")
+        else:
+            print("✓ Firmware verified by device")
         print()
         
         print("="*70)
         print("STEP 4: EXIT TO APPLICATION")
-        print("="*70)
-        if not updater.set_program(1):  # 1 = Application
-            print("⚠ Warning: Could not send exit command (device may have already rebooted)")
+        print("="*70, flush=True)
+        if updater.change_program(1, timeout=reboot_window):  # 1 = Application
+            print("✓ Application running")
         else:
-            print("✓ Application mode command sent")
-        print("Waiting 3 seconds for reboot...")
-        time.sleep(3)
+            print("⚠ Warning: Application start not confirmed (it may still be starting)")
         print()
         
         print("="*70)
         print("✅ FIRMWARE UPDATE COMPLETE!")
-        print("="*70)
+        print("="*70, flush=True)
+        return True
         
     except Exception as e:
         print()
         print("="*70)
         print(f"❌ UPDATE FAILED: {e}")
-        print("="*70)
+        print("="*70, flush=True)
         import traceback
         traceback.print_exc()
+        return False
+    finally:
+        if previous_sigint is not None:
+            signal.signal(signal.SIGINT, previous_sigint)
+        updater.close()
+
+
+def main() -> None:
+    args = parse_args()
+    # Status output is flushed explicitly at each step (and by the rate-limited
+    # progress lines) instead of issuing a write() for every line
+    if hasattr(sys.stdout, 'reconfigure'):
+        sys.stdout.reconfigure(line_buffering=False)
+    
+    print("="*70)
+    print(f"FIRMWARE UPDATE - Node {args.node_id}")
+    print(f"File: {args.hex_file}")
+    print("="*70)
+    print()
+    
+    print("Loading firmware file...")
+    try:
+        firmware_data = load_firmware(args.hex_file, binary=args.binary,
+                                      expected_crc32=args.expected_crc32)
+    except ValueError as e:
+        print(f"✗ {e}")
+        sys.exit(1)
+    print()
+    
+    print("Connecting to CAN bus...", flush=True)
+    bus = open_bus(args.can_interface, bitrate=250000, force_setup=args.force_setup,
+                   node_ids=[args.node_id])
+    print()
+    
+    try:
+        ok = run_update(bus, args.node_id, firmware_data, block=args.block,
+                        tx_batch=args.tx_batch, tx_batch_delay=args.tx_batch_delay_ms / 1000.0,
+                        segment_timeout=args.frame_timeout_ms / 1000.0,
+                        segment_attempts=args.retry_count,
+                        reboot_window=args.reboot_window_s)
     finally:
         bus.shutdown()
+    sys.exit(0 if ok else 1)
 
 
 if __name__ == "__main__":